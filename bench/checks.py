@@ -0,0 +1,136 @@
+# Regression checks for the Hunter functions
+#
+# Runs each function's flexio_handler through a fake flex object against the
+# local Hunter API stub (bench/stub_server.py) and checks behavior that has
+# broken before. Each check loads fresh copies of the function scripts with
+# their own cache file, so that the checks don't share state. The exit status
+# is non-zero if any check fails.
+#
+# Usage:
+#   python bench/checks.py [--checks name,name]
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import run
+import stub_server
+
+class FlexOutput():
+
+    def __init__(self):
+        self.content_type = None
+        self.chunks = []
+
+    def write(self, content):
+        self.chunks.append(content)
+
+def invoke(module, input, api_key='checks'):
+    # returns the decoded output of an invocation
+    flex = run.Flex(api_key, input)
+    flex.output = FlexOutput()
+    module.flexio_handler(flex)
+    return json.loads(b''.join(flex.output.chunks))
+
+def load(filename, stub):
+    # load a fresh copy of a function pointed at the stub with its own cache
+    os.environ['HUNTER_API_URL'] = 'http://127.0.0.1:%d/v2/' % stub.server_port
+    os.environ['HUNTER_CACHE_PATH'] = os.path.join(tempfile.mkdtemp(), 'hunter-cache.sqlite')
+    return run.load_function(filename)
+
+def check_probe_released_on_deadline():
+    # a half-open probe that runs out of deadline while it waits on the rate
+    # limiter must not leave the breaker stuck open
+    stub = stub_server.start_server(stub_server.StubConfig())
+    module = load('hunter-verify-email.py', stub)
+    breaker = module.get_circuit_breaker('email-verifier', {'email': 'a@x.com'})
+    for i in range(module.BREAKER_THRESHOLD):
+        breaker.failure()
+    breaker.open_until = time.monotonic() - 1
+    limiter = module.get_rate_limiter('checks', 'email-verifier', {})
+    limiter.blocked_until = time.monotonic() + 5
+    row = invoke(module, ['a@x.com', 'score', 'cache=false&deadline=0.5'])[0]
+    assert row[0] == 'Error: 504 Deadline Exceeded', row
+    assert breaker.probing is False, 'breaker left probing'
+    limiter.blocked_until = 0
+    row = invoke(module, ['b@x.com', 'score', 'cache=false'])[0]
+    assert row[0] == 91, row
+
+def check_deadline_timeout_not_breaker_failure():
+    # requests cut short by the deadline fail with a 504 and don't count
+    # against the domain's circuit breaker
+    stub = stub_server.start_server(stub_server.StubConfig(latency_ms=400))
+    module = load('hunter-verify-email.py', stub)
+    for i in range(module.BREAKER_THRESHOLD):
+        row = invoke(module, ['p%d@slow.com' % i, 'score', 'cache=false&deadline=0.15'])[0]
+        assert row[0] == 'Error: 504 Deadline Exceeded', row
+    breaker = module.get_circuit_breaker('email-verifier', {'email': 'a@slow.com'})
+    assert breaker.failures == 0 and breaker.open_until is None, 'breaker counted deadline timeouts'
+    row = invoke(module, ['q@slow.com', 'score', 'cache=false'])[0]
+    assert row[0] == 91, row
+
+def check_index_capped():
+    # the people indexed from domain-searches stay under their row cap, with
+    # the most recently indexed people kept
+    stub = stub_server.start_server(stub_server.StubConfig(domain_size=300))
+    module = load('hunter-enrich-org.py', stub)
+    module.INDEX_MAX_ROWS = 1000
+    for i in range(8):
+        invoke(module, ['d%d.com' % i, 'email', 'limit=300'])
+    connection = module.get_cache_connection()
+    count = connection.execute('select count(*) from people').fetchone()[0]
+    assert 0 < count <= module.INDEX_MAX_ROWS, count
+    latest = connection.execute("select count(*) from people where domain = 'd7.com'").fetchone()[0]
+    assert latest == 300, latest
+
+def check_revalidation_ignores_deadline():
+    # a stale response served to a lookup with a short deadline is still
+    # revalidated in the background after the lookup returns
+    stub = stub_server.start_server(stub_server.StubConfig(latency_ms=100))
+    module = load('hunter-verify-email.py', stub)
+    invoke(module, ['a@x.com', 'score', ''])
+    connection = module.get_cache_connection()
+    with module.cache_lock:
+        connection.execute('update cache set expires = ?', (time.time() - 10,))
+    row = invoke(module, ['a@x.com', 'score', 'stale=true&deadline=0.05'])[0]
+    assert row[0] == 91, row
+    for i in range(40):
+        with module.cache_lock:
+            expires = connection.execute('select expires from cache').fetchone()[0]
+        if expires > time.time():
+            return
+        time.sleep(0.05)
+    raise AssertionError('stale response not revalidated')
+
+CHECKS = {
+    'probe_released_on_deadline': check_probe_released_on_deadline,
+    'deadline_timeout_not_breaker_failure': check_deadline_timeout_not_breaker_failure,
+    'index_capped': check_index_capped,
+    'revalidation_ignores_deadline': check_revalidation_ignores_deadline
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Run regression checks for the Hunter functions')
+    parser.add_argument('--checks', default=','.join(CHECKS), help='checks to run: ' + ','.join(CHECKS))
+    args = parser.parse_args()
+
+    failed = 0
+    for name in args.checks.split(','):
+        name = name.strip()
+        try:
+            CHECKS[name]()
+            print('%-40s ok' % name)
+        except Exception:
+            failed = failed + 1
+            print('%-40s FAIL' % name)
+            traceback.print_exc()
+    sys.exit(1 if failed > 0 else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Projection benchmark for hunter-enrich-org
+#
+# Projects a generated domain-search response with 10k emails onto the
+# function's output columns, both the way rows used to be built (a merge of
+# the domain's and the email's values and a property map lookup for each
+# column of each row) and with the compiled projection (get_projection and
+# bind_projection), and reports the best time of each. The two are checked
+# to give the same rows before anything is timed.
+#
+# Usage:
+#   python bench/projection.py [--emails 10000] [--properties '*'] [--runs 5] [--json]
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import run
+import stub_server
+
+def get_content(emails):
+    # a domain-search response with all the emails on one page
+    config = stub_server.StubConfig(domain_size=emails)
+    content = stub_server.get_domain_search(config, {'domain': 'example.com', 'limit': emails}, None)
+    return content['data']
+
+def get_rows_mapped(content, selection):
+    # rows built the way they were before the projections were compiled
+    property_map = OrderedDict()
+    property_map['organization'] = 'organization'
+    property_map['domain'] = 'domain'
+    property_map['email_disposable'] = 'disposable'
+    property_map['email_webmail'] = 'webmail'
+    property_map['first_name'] = 'first_name'
+    property_map['last_name'] = 'last_name'
+    property_map['email'] = 'value'
+    property_map['email_type'] = 'type'
+    property_map['email_score'] = 'confidence'
+    property_map['phone'] = 'phone_number'
+    property_map['position'] = 'position'
+    property_map['seniority'] = 'seniority'
+    property_map['department'] = 'department'
+    property_map['linkedin'] = 'linkedin'
+    property_map['twitter'] = 'twitter'
+
+    properties = [p.lower().strip() for p in selection]
+    if len(properties) == 1 and (properties[0] == '' or properties[0] == '*'):
+        properties = list(property_map.keys())
+
+    header_info = {key: content.get(key,'') for key in ('domain', 'disposable', 'webmail', 'pattern', 'organization')}
+    rows = []
+    for detail_info in content.get('emails',[]):
+        item = {**header_info, **detail_info}
+        rows.append([item.get(property_map.get(p,''),'') or '' for p in properties])
+    return rows
+
+def get_rows_projected(module, content, selection):
+    # rows built with the compiled projection, as the function builds them
+    properties, projection = module.get_projection(tuple(selection))
+    header_info = {key: content.get(key,'') for key in ('domain', 'disposable', 'webmail', 'pattern', 'organization')}
+    plan = module.bind_projection(projection, header_info)
+    return [[value if key is None else detail_info.get(key,'') or '' for value, key in plan] for detail_info in content.get('emails',[])]
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the old and the compiled projection of domain-search rows')
+    parser.add_argument('--emails', type=int, default=10000, help='number of emails in the response')
+    parser.add_argument('--properties', default='*', help='comma-separated properties to project')
+    parser.add_argument('--runs', type=int, default=5, help='number of timed runs; the best is reported')
+    parser.add_argument('--json', action='store_true', help='output the results as JSON')
+    args = parser.parse_args()
+
+    module = run.load_function('hunter-enrich-org.py')
+    content = get_content(args.emails)
+    selection = args.properties.split(',')
+
+    mapped = get_rows_mapped(content, selection)
+    projected = get_rows_projected(module, content, selection)
+    if mapped != projected:
+        print('projections differ', file=sys.stderr)
+        return 1
+
+    timings = {
+        'mapped': lambda: get_rows_mapped(content, selection),
+        'projected': lambda: get_rows_projected(module, content, selection)
+    }
+    results = {name: min(timeit.repeat(fn, number=1, repeat=args.runs)) * 1000 for name, fn in timings.items()}
+    result = {
+        'emails': args.emails,
+        'columns': len(projected[0]) if len(projected) > 0 else 0,
+        'mapped_ms': round(results['mapped'], 3),
+        'projected_ms': round(results['projected'], 3),
+        'speedup': round(results['mapped'] / results['projected'], 2) if results['projected'] > 0 else None
+    }
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print('%d emails, %d columns' % (result['emails'], result['columns']))
+        print('%-10s %9.2f ms' % ('mapped', result['mapped_ms']))
+        print('%-10s %9.2f ms  (%.1fx)' % ('projected', result['projected_ms'], result['speedup'] or 0))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,248 @@
+# Offline benchmark and load test for the Hunter functions
+#
+# Drives each function's flexio_handler through a fake flex object against
+# the local Hunter API stub (bench/stub_server.py), so no live requests are
+# made and no credits are used. Three scenarios are measured:
+#
+#   single      one cell at a time, one invocation after another
+#   batch       one invocation with a list/range of rows (or a large limit for
+#               hunter-enrich-org)
+#   concurrent  many single-cell invocations at once, as when a sheet recalcs
+#
+# Throughput and p50/p95/p99 latencies are printed and, with --output, written
+# as JSON so that runs on different branches can be compared.
+#
+# Usage:
+#   python bench/run.py [--functions org,people,verify] [--scenarios single,batch,concurrent]
+#                       [--iterations 200] [--batch-size 500] [--concurrency 16]
+#                       [--latency-ms 20] [--jitter-ms 10] [--rate-429 0] [--rate-5xx 0]
+#                       [--url http://127.0.0.1:8901/v2/] [--keys 1] [--cache] [--output results.json]
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stub_server
+
+FUNCTIONS = {
+    'org': 'hunter-enrich-org.py',
+    'people': 'hunter-enrich-people.py',
+    'verify': 'hunter-verify-email.py'
+}
+
+SCENARIOS = ('single', 'batch', 'concurrent')
+
+class FlexInput():
+
+    def __init__(self, content):
+        self.content = content
+
+    def read(self):
+        return self.content
+
+class FlexOutput():
+
+    def __init__(self):
+        self.content_type = None
+        self.size = 0
+
+    def write(self, content):
+        self.size = self.size + len(content)
+
+class Flex():
+
+    # the parts of the flex object the functions use
+
+    def __init__(self, api_key, input):
+        self.vars = {'hunter_api_key': api_key}
+        self.input = FlexInput(json.dumps(input))
+        self.output = FlexOutput()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Hunter functions against a local API stub')
+    parser.add_argument('--functions', default='org,people,verify', help='functions to run: ' + ','.join(FUNCTIONS))
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='scenarios to run: ' + ','.join(SCENARIOS))
+    parser.add_argument('--iterations', type=int, default=200, help='invocations per single/concurrent scenario')
+    parser.add_argument('--batch-size', type=int, default=500, help='rows per batch invocation')
+    parser.add_argument('--batch-iterations', type=int, default=5, help='invocations per batch scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent invocations for the concurrent scenario')
+    parser.add_argument('--url', help='base url of an already running stub; otherwise a stub is started in-process')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--rate-429', type=float, default=0)
+    parser.add_argument('--rate-5xx', type=float, default=0)
+    parser.add_argument('--domain-size', type=int, default=1000)
+    parser.add_argument('--payloads', help='directory of recorded <endpoint>.json responses to replay')
+    parser.add_argument('--keys', type=int, default=1, help='number of api keys to spread requests across')
+    parser.add_argument('--cache', action='store_true', help='leave the response cache on (a fresh cache file is used)')
+    parser.add_argument('--config', default='', help='extra config string options passed to every invocation')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    stub = None
+    url = args.url
+    if url is None:
+        stub = stub_server.StubConfig(args.latency_ms, args.jitter_ms, args.rate_429, args.rate_5xx, args.domain_size, args.payloads, seed=1)
+        server = stub_server.start_server(stub)
+        url = 'http://127.0.0.1:%d/v2/' % server.server_port
+
+    # the functions read these when they're loaded
+    os.environ['HUNTER_API_URL'] = url
+    os.environ['HUNTER_CACHE_PATH'] = os.path.join(tempfile.mkdtemp(), 'hunter-cache.sqlite')
+
+    # the stub has no rate limits, so the client-side limits are lifted to
+    # measure the functions themselves
+    config = 'rate_per_second=1000000&rate_per_minute=1000000000'
+    if args.cache is False:
+        config = config + '&cache=false'
+    if args.config != '':
+        config = config + '&' + args.config
+
+    results = []
+    for name in args.functions.split(','):
+        module = load_function(FUNCTIONS[name.strip()])
+        for scenario in args.scenarios.split(','):
+            scenario = scenario.strip()
+            before = dict(stub.counts) if stub is not None else {}
+            limiters_before = module.get_rate_limiter_stats()
+            result = run_scenario(module, name.strip(), scenario, config, args)
+            if stub is not None:
+                result['upstream'] = {k: v - before.get(k, 0) for k, v in stub.counts.items() if v - before.get(k, 0) > 0}
+            result['rate_limiters'] = get_stats_delta(limiters_before, module.get_rate_limiter_stats())
+            results.append(result)
+            print_result(result)
+
+    if args.output is not None:
+        report = {
+            'environment': get_environment(),
+            'settings': {k: v for k, v in vars(args).items() if k != 'output'},
+            'results': results
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+def load_function(filename):
+    spec = importlib.util.spec_from_file_location(filename[:-3].replace('-', '_'), os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def get_input(name, scenario, i, config, batch_size):
+    # inputs are unique per invocation so that each one is a real lookup
+    if name == 'org':
+        limit = batch_size if scenario == 'batch' else 100
+        return ['domain%d.com' % i, '*', config + '&limit=%d' % limit]
+    if name == 'people':
+        if scenario == 'batch':
+            return ['domain%d.com' % i, ['First%d' % j for j in range(batch_size)], 'Last', '*', config]
+        return ['domain%d.com' % i, 'First%d' % i, 'Last', '*', config]
+    if scenario == 'batch':
+        return [['person%d@domain%d.com' % (j, i) for j in range(batch_size)], '*', config]
+    return ['person%d@domain.com' % i, '*', config]
+
+def invoke(module, input, api_key='benchmark'):
+    # returns the latency in seconds, the number of bytes written and whether
+    # the invocation succeeded
+    flex = Flex(api_key, input)
+    start = time.perf_counter()
+    try:
+        module.flexio_handler(flex)
+        ok = True
+    except Exception:
+        ok = False
+    return time.perf_counter() - start, flex.output.size, ok
+
+def run_scenario(module, name, scenario, config, args):
+    if scenario == 'batch':
+        count = args.batch_iterations
+        rows = args.batch_size
+    else:
+        count = args.iterations
+        rows = 1
+
+    inputs = [get_input(name, scenario, i, config, args.batch_size) for i in range(count)]
+    api_key = ','.join('benchmark%d' % i for i in range(args.keys)) if args.keys > 1 else 'benchmark'
+    samples = []
+    samples_lock = threading.Lock()
+
+    def worker(items):
+        for input in items:
+            sample = invoke(module, input, api_key)
+            with samples_lock:
+                samples.append(sample)
+
+    start = time.perf_counter()
+    if scenario == 'concurrent':
+        threads = [threading.Thread(target=worker, args=(inputs[i::args.concurrency],)) for i in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    else:
+        worker(inputs)
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(s[0] for s in samples)
+    return {
+        'function': FUNCTIONS[name],
+        'scenario': scenario,
+        'invocations': len(samples),
+        'rows_per_invocation': rows,
+        'errors': sum(1 for s in samples if s[2] is False),
+        'seconds': round(elapsed, 4),
+        'invocations_per_second': round(len(samples) / elapsed, 2),
+        'rows_per_second': round(len(samples) * rows / elapsed, 2),
+        'output_bytes': sum(s[1] for s in samples),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 3),
+            'p95': round(percentile(latencies, 95) * 1000, 3),
+            'p99': round(percentile(latencies, 99) * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3) if len(latencies) > 0 else 0
+        }
+    }
+
+def get_stats_delta(before, after):
+    # the change in the rate limiter counters of each endpoint
+    delta = {}
+    for endpoint, stats in after.items():
+        previous = before.get(endpoint, {})
+        delta[endpoint] = {k: round(v - previous.get(k, 0), 6) for k, v in stats.items()}
+    return delta
+
+def percentile(values, p):
+    # nearest-rank percentile of sorted values
+    if len(values) == 0:
+        return 0
+    rank = max(1, int(round(p / 100 * len(values) + 0.5)))
+    return values[min(rank, len(values)) - 1]
+
+def print_result(r):
+    latency = r['latency_ms']
+    print('%-24s %-10s %5d calls %7.1f calls/s %9.1f rows/s  p50 %8.2f  p95 %8.2f  p99 %8.2f ms  errors %d' % (
+        r['function'], r['scenario'], r['invocations'], r['invocations_per_second'], r['rows_per_second'],
+        latency['p50'], latency['p95'], latency['p99'], r['errors']))
+
+def get_environment():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=ROOT).stdout.strip()
+    except OSError:
+        revision = ''
+    return {
+        'revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    }
+
+if __name__ == '__main__':
+    main()
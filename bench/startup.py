@@ -0,0 +1,94 @@
+# Startup benchmark for the Hunter functions
+#
+# Loads each function script in a fresh interpreter with `python -X importtime`
+# and totals the time spent importing the modules the script pulls in beyond
+# what a bare interpreter already imports. Each total is the median of several
+# runs and is checked against a budget so that cold start regressions are
+# caught; the exit status is non-zero if any script is over its budget.
+#
+# Usage:
+#   python bench/startup.py [--runs 5] [--budget-ms 15] [--json]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPTS = [
+    'hunter-enrich-org.py',
+    'hunter-enrich-people.py',
+    'hunter-verify-email.py'
+]
+
+# load a script the same way the function runtime does; the script is
+# executed as a module from its path rather than imported by name
+LOAD_SCRIPT = '''
+import importlib.util, sys
+spec = importlib.util.spec_from_file_location('handler', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+'''
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure and check the import time of the Hunter functions')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs per script')
+    parser.add_argument('--budget-ms', type=float, default=15, help='import time budget per script in milliseconds')
+    parser.add_argument('--json', action='store_true', help='output the results as JSON')
+    args = parser.parse_args()
+
+    baseline = get_imported_modules(['-c', 'pass'])
+
+    results = []
+    for script in SCRIPTS:
+        path = os.path.join(ROOT, script)
+        samples = [get_import_time(path, baseline) for i in range(args.runs)]
+        total = statistics.median(s[0] for s in samples)
+        slowest = sorted(samples[-1][1].items(), key=lambda item: item[1], reverse=True)[:5]
+        results.append({
+            'script': script,
+            'import_ms': round(total / 1000, 3),
+            'budget_ms': args.budget_ms,
+            'ok': total / 1000 <= args.budget_ms,
+            'slowest': [{'module': m, 'ms': round(t / 1000, 3)} for m, t in slowest]
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            status = 'ok' if r['ok'] else 'OVER BUDGET'
+            slowest = ', '.join('%s %.1fms' % (s['module'], s['ms']) for s in r['slowest'])
+            print('%-26s %7.2f ms / %.0f ms  %s  (%s)' % (r['script'], r['import_ms'], r['budget_ms'], status, slowest))
+
+    return 0 if all(r['ok'] for r in results) else 1
+
+def get_import_time(path, baseline):
+    # returns the total import time in microseconds of the top-level imports
+    # made by the script and the time of each of those imports
+    modules = get_imported_modules(['-c', LOAD_SCRIPT, path])
+    modules = {m: t for m, t in modules.items() if m not in baseline}
+    return sum(modules.values()), modules
+
+def get_imported_modules(args):
+    # run the interpreter with import timing and return the cumulative time
+    # of each top-level import in microseconds
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + args, capture_output=True, text=True, check=True, cwd=ROOT)
+    modules = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2]
+        if name.startswith('  '):
+            continue # nested import; counted in its parent's cumulative time
+        modules[name.strip()] = modules.get(name.strip(), 0) + int(parts[1])
+    return modules
+
+if __name__ == '__main__':
+    sys.exit(main())
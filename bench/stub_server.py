@@ -0,0 +1,260 @@
+# Local stub of the Hunter API for benchmarks and load tests
+#
+# Serves domain-search, email-finder, email-verifier and account responses
+# without calling api.hunter.io. Responses are replayed from recorded payloads when a
+# payload directory is given (one '<endpoint>.json' file per endpoint holding
+# a full API response) and are otherwise generated from the query. Latency,
+# jitter and the rate of 429 and 5xx responses are configurable so that the
+# functions can be measured under flaky upstream conditions.
+#
+# Usage:
+#   python bench/stub_server.py [--port 8901] [--latency-ms 50] [--jitter-ms 20]
+#                               [--rate-429 0.01] [--rate-5xx 0.01] [--payloads DIR]
+#
+# Then point the functions at it with HUNTER_API_URL=http://127.0.0.1:8901/v2/
+
+import argparse
+import copy
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ENDPOINTS = ('domain-search', 'email-finder', 'email-verifier', 'account')
+
+class StubConfig():
+
+    def __init__(self, latency_ms=0, jitter_ms=0, rate_429=0, rate_5xx=0, domain_size=250, payloads=None, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.domain_size = domain_size
+        self.payloads = load_payloads(payloads)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def draw(self):
+        with self.lock:
+            return self.random.random(), self.random.uniform(-1, 1)
+
+class StubServer(ThreadingHTTPServer):
+
+    request_queue_size = 256
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that time out close their connection before the response
+        # is written; that's expected and not worth a traceback
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    config = None # set on the subclass created for each server
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        config = self.config
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        endpoint = url.path.rstrip('/').rsplit('/', 1)[-1]
+        config.count('requests')
+
+        failure, jitter = config.draw()
+        delay = max(0, config.latency_ms + jitter * config.jitter_ms) / 1000
+        if delay > 0:
+            time.sleep(delay)
+
+        if endpoint not in ENDPOINTS:
+            config.count('404')
+            return self.send_json(404, {'errors': [{'id': 'not_found', 'code': 404}]})
+        if 'api_key' not in query:
+            config.count('401')
+            return self.send_json(401, {'errors': [{'id': 'authentication_failed', 'code': 401}]})
+        if failure < config.rate_429:
+            config.count('429')
+            return self.send_json(429, {'errors': [{'id': 'too_many_requests', 'code': 429}]}, {'Retry-After': '1'})
+        if failure < config.rate_429 + config.rate_5xx:
+            config.count('5xx')
+            return self.send_json(503, {'errors': [{'id': 'service_unavailable', 'code': 503}]})
+
+        config.count(endpoint)
+        self.send_json(200, get_response(config, endpoint, query))
+
+    def send_json(self, status, content, headers=None):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+def load_payloads(path):
+    payloads = {}
+    if path is None:
+        return payloads
+    for endpoint in ENDPOINTS:
+        filename = os.path.join(path, endpoint + '.json')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                payloads[endpoint] = json.load(f)
+    return payloads
+
+def get_response(config, endpoint, query):
+    recorded = config.payloads.get(endpoint)
+    if endpoint == 'domain-search':
+        return get_domain_search(config, query, recorded)
+    if recorded is not None:
+        return recorded
+    if endpoint == 'email-finder':
+        return get_email_finder(query)
+    if endpoint == 'account':
+        return get_account(query)
+    return get_email_verifier(query)
+
+def get_domain_search(config, query, recorded):
+    domain = query.get('domain', '')
+    offset = int(query.get('offset', 0))
+    limit = int(query.get('limit', 10))
+    if recorded is not None:
+        content = copy.deepcopy(recorded)
+        emails = content.get('data', {}).get('emails', [])
+        content['data']['emails'] = emails[offset:offset+limit]
+        content['meta'] = {'results': len(emails), 'limit': limit, 'offset': offset}
+        return content
+    emails = []
+    for i in range(offset, min(config.domain_size, offset + limit)):
+        emails.append({
+            'value': 'person%d@%s' % (i, domain),
+            'type': 'personal',
+            'confidence': 90 - i % 40,
+            'sources': [{'domain': domain, 'uri': 'http://%s/team' % domain, 'extracted_on': '2020-01-01', 'last_seen_on': '2020-06-01', 'still_on_page': True}],
+            'first_name': 'First%d' % i,
+            'last_name': 'Last%d' % i,
+            'position': 'Position %d' % i,
+            'seniority': 'senior',
+            'department': 'executive',
+            'linkedin': None,
+            'twitter': None,
+            'phone_number': None,
+            'verification': {'date': '2020-06-01', 'status': 'valid'}
+        })
+    return {
+        'data': {
+            'domain': domain,
+            'disposable': False,
+            'webmail': False,
+            'accept_all': False,
+            'pattern': '{first}',
+            'organization': domain.split('.')[0].capitalize(),
+            'emails': emails
+        },
+        'meta': {'results': config.domain_size, 'limit': limit, 'offset': offset}
+    }
+
+def get_email_finder(query):
+    domain = query.get('domain', '')
+    first_name = query.get('first_name', '')
+    last_name = query.get('last_name', '')
+    return {
+        'data': {
+            'first_name': first_name,
+            'last_name': last_name,
+            'email': (first_name + '.' + last_name).lower() + '@' + domain,
+            'score': 91,
+            'domain': domain,
+            'accept_all': False,
+            'position': 'Position',
+            'twitter': None,
+            'linkedin_url': None,
+            'phone_number': None,
+            'company': domain.split('.')[0].capitalize(),
+            'sources': []
+        },
+        'meta': {'params': {k: v for k, v in query.items() if k != 'api_key'}}
+    }
+
+def get_email_verifier(query):
+    email = query.get('email', '')
+    return {
+        'data': {
+            'status': 'valid',
+            'result': 'deliverable',
+            'score': 91,
+            'email': email,
+            'regexp': True,
+            'gibberish': False,
+            'disposable': False,
+            'webmail': email.endswith('@gmail.com'),
+            'mx_records': True,
+            'smtp_server': True,
+            'smtp_check': True,
+            'accept_all': False,
+            'block': False,
+            'sources': []
+        },
+        'meta': {'params': {k: v for k, v in query.items() if k != 'api_key'}}
+    }
+
+def get_account(query):
+    return {
+        'data': {
+            'email': 'benchmark@example.com',
+            'plan_name': 'Stub',
+            'requests': {
+                'searches': {'used': 0, 'available': 1000000},
+                'verifications': {'used': 0, 'available': 1000000}
+            }
+        }
+    }
+
+def start_server(config, host='127.0.0.1', port=0):
+    # start the stub in a background thread and return the server; the api
+    # base url is 'http://<host>:<server.server_port>/v2/'
+    handler = type('ConfiguredStubHandler', (StubHandler,), {'config': config})
+    server = StubServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stub of the Hunter API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8901)
+    parser.add_argument('--latency-ms', type=float, default=0, help='mean response latency')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='maximum deviation from the mean latency')
+    parser.add_argument('--rate-429', type=float, default=0, help='fraction of requests answered with a 429')
+    parser.add_argument('--rate-5xx', type=float, default=0, help='fraction of requests answered with a 503')
+    parser.add_argument('--domain-size', type=int, default=250, help='number of emails for a generated domain-search')
+    parser.add_argument('--payloads', help='directory of recorded <endpoint>.json responses to replay')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency_ms, args.jitter_ms, args.rate_429, args.rate_5xx, args.domain_size, args.payloads, args.seed)
+    handler = type('ConfiguredStubHandler', (StubHandler,), {'config': config})
+    server = StubServer((args.host, args.port), handler)
+    print('Serving the Hunter API stub at http://%s:%d/v2/' % (args.host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -7,15 +7,15 @@
 # params:
 #   - name: domain
 #     type: string
-#     description: The domain name from which you want to find the email address. For example, "asana.com".
+#     description: The domain name from which you want to find the email address. For example, "asana.com". May also be a list or a range of domains, one for each person.
 #     required: true
 #   - name: first_name
 #     type: string
-#     description: The person's first name. It doesn't need to be in lowercase.
+#     description: The person's first name. It doesn't need to be in lowercase. May also be a list or a range of first names, one for each person.
 #     required: true
 #   - name: last_name
 #     type: string
-#     description: The person's last name. It doesn't need to be in lowercase.
+#     description: The person's last name. It doesn't need to be in lowercase. May also be a list or a range of last names, one for each person.
 #     required: true
 #   - name: properties
 #     type: array
@@ -39,7 +39,7 @@
 #     description: The email address of the person
 #   - name: email_score
 #     type: string
-#     description: An estimation of the probability the email address returned is correct
+#     description: An estimation of the probability the email address returned is correct; emails built from the domain's email pattern (with the "pattern=true" config option) have a score of 10
 #   - name: phone
 #     type: string
 #     description: The phone number of the person
@@ -52,93 +52,1352 @@
 # ---
 
 import json
-import urllib
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+import os
+import random
+import sqlite3
+import stat
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import functools
 import itertools
-from datetime import *
-from cerberus import Validator
-from collections import OrderedDict
+from datetime import date, datetime
+from collections import OrderedDict, deque
+
+# map this function's property names to the API's property names
+PROPERTY_MAP = OrderedDict()
+PROPERTY_MAP['organization'] = 'company'
+PROPERTY_MAP['domain'] = 'domain'
+PROPERTY_MAP['first_name'] = 'first_name'
+PROPERTY_MAP['last_name'] = 'last_name'
+PROPERTY_MAP['email'] = 'email'
+PROPERTY_MAP['email_score'] = 'score'
+PROPERTY_MAP['phone'] = 'phone_number'
+PROPERTY_MAP['position'] = 'position'
 
 # main function entry point
 def flexio_handler(flex):
 
-    # get the api key from the variable input
-    auth_token = dict(flex.vars).get('hunter_api_key')
-    if auth_token is None:
-        raise ValueError
+    metrics = Metrics('hunter-enrich-people')
+
+    # get the variable input, which holds the api keys
+    variables = dict(flex.vars)
 
     # get the input
     input = flex.input.read()
-    input = json.loads(input)
+    input = json_loads(input)
     if not isinstance(input, list):
         raise ValueError
+    metrics.mark('parse')
+
+    # map the values to the parameter names based on the positions of the
+    # keys/values and validate them; if the input is invalid return an error
+    input = validate_input(input)
+    if input is None:
+        raise ValueError
+    metrics.mark('validate')
+
+    # get the properties to return and the API's property for each of them;
+    # these are resolved once per selection
+    properties, keys = get_projection(tuple(input['properties']))
+
+    # get any configuration settings
+    config = urllib.parse.parse_qs(input['config'])
+    config = {k: v[0] for k, v in config.items()}
+    auth_tokens = get_auth_tokens(variables, config)
+    if len(auth_tokens) == 0:
+        raise ValueError
+    options = get_request_options(config)
+    options['metrics'] = metrics
+    metrics.enable(config)
+
+    concurrency = max(1, int(config.get('concurrency', 8)))
+
+    # people found by a domain-search are answered from the cache unless the
+    # cache is bypassed; with 'pattern=true' an email is also built from the
+    # domain's email pattern for people who weren't found
+    local = config.get('local', 'true').lower() == 'true' and options['cache'] is True and options['refresh'] is False
+    pattern = config.get('pattern', 'false').lower() == 'true'
+
+    # 'hash' adds a column with a hash of each row's values, which only
+    # changes when the row does
+    row_hash = config.get('hash', 'false').lower() == 'true'
+
+    # find the emails for the people concurrently; the domain, first name and
+    # last name can each be a single value or a list or range of values, with
+    # a single value applying to every person, and a row is returned for each
+    # person in the order given
+    people = get_people(input['domain'], input['first_name'], input['last_name'])
+    if people is None:
+        raise ValueError
+
+    session = get_session(retry=options['deadline'] is None)
+    metrics.mark('session')
+
+    def get_row(person):
+        if '' in person:
+            return ['' for p in properties]
+        try:
+            # see here for more info:
+            # https://hunter.io/api/docs#email-finder
+            url_query_params = {
+                'domain': person[0],
+                'first_name': person[1],
+                'last_name': person[2]
+            }
+            content = None
+            if local is True:
+                content = find_person(person[0], person[1], person[2], pattern, metrics)
+            if content is None:
+                content = get_hunter_data(session, auth_tokens, 'email-finder', url_query_params, options)
+            content = content.get('data', {}) or {}
+        except (OSError, ValueError) as e: # requests' errors are OSErrors
+            return [get_error_message(e)] + ['' for p in properties[1:]]
+        return [content.get(key,'') or '' for key in keys]
+
+    # duplicate inputs are only looked up once; rows are written out in the
+    # order given a chunk at a time as the lookups complete, so the first rows
+    # of a large input are written while the rest are still being looked up
+    unique = list(dict.fromkeys(people))
+    lookups = map_concurrent(get_row, unique, concurrency)
+    rows = {}
+
+    def get_rows():
+        for item in people:
+            while item not in rows:
+                row = next(lookups)
+                rows[unique[len(rows)]] = row + [get_row_hash(row)] if row_hash is True else row
+            yield rows[item]
+
+    count = write_rows(flex, get_rows(), metrics)
+    metrics.add('rows', count)
+    metrics.emit()
 
-    # define the expected parameters and map the values to the parameter names
-    # based on the positions of the keys/values
+@functools.lru_cache(maxsize=None)
+def get_params():
+    # define the expected parameters; these are defined once per process
     params = OrderedDict()
-    params['domain'] = {'required': True, 'type': 'string'}
-    params['first_name'] = {'required': True, 'type': 'string'}
-    params['last_name'] = {'required': True, 'type': 'string'}
+    params['domain'] = {'required': True, 'validator': validator_list, 'coerce': to_value_list}
+    params['first_name'] = {'required': True, 'validator': validator_list, 'coerce': to_value_list}
+    params['last_name'] = {'required': True, 'validator': validator_list, 'coerce': to_value_list}
     params['properties'] = {'required': False, 'validator': validator_list, 'coerce': to_list, 'default': '*'}
+    params['config'] = {'required': False, 'type': 'string', 'default': ''} # index-styled config string
+    return params
+
+@functools.lru_cache(maxsize=None)
+def get_validator():
+    # cerberus is only imported when an input needs the validator
+    from cerberus import Validator
+    return Validator(get_params(), allow_unknown = True)
+
+validator_lock = threading.Lock()
+
+def validate_input(input):
+
+    # map the values to the parameter names based on the positions of the keys/values
+    params = get_params()
     input = dict(zip(params.keys(), input))
 
-    # validate the mapped input against the validator
-    # if the input is valid return an error
-    v = Validator(params, allow_unknown = True)
-    input = v.validated(input)
-    if input is None:
-        raise ValueError
+    # inputs with only string values, which is the common case of values
+    # entered in a cell, are validated directly; this gives the same result
+    # as the validator, which handles everything else
+    if all(isinstance(value, str) for value in input.values()):
+        result = {}
+        for name, schema in params.items():
+            value = input.get(name)
+            if value is None:
+                if schema.get('required') is True:
+                    return None
+                value = schema.get('default')
+            coerce = schema.get('coerce')
+            result[name] = value if coerce is None else coerce(value)
+        return result
+
+    # the validator keeps state from the last validation, so it's only used
+    # by one thread at a time
+    with validator_lock:
+        return get_validator().validated(input)
 
-    # map this function's property names to the API's property names
-    property_map = OrderedDict()
-    property_map['organization'] = 'company'
-    property_map['domain'] = 'domain'
-    property_map['first_name'] = 'first_name'
-    property_map['last_name'] = 'last_name'
-    property_map['email'] = 'email'
-    property_map['email_score'] = 'score'
-    property_map['phone'] = 'phone_number'
-    property_map['position'] = 'position'
-
-    # get the properties to return and the property map;
-    # if we have a wildcard, get all the properties
-    properties = [p.lower().strip() for p in input['properties']]
+@functools.lru_cache(maxsize=256)
+def get_projection(properties):
+
+    # get the properties to return; if we have a wildcard, get all the properties
+    properties = tuple(p.lower().strip() for p in properties)
     if len(properties) == 1 and (properties[0] == '' or properties[0] == '*'):
-        properties = list(property_map.keys())
-
-    # see here for more info:
-    # https://hunter.io/api/docs#email-verifier
-    url_query_params = {
-        'domain': input['domain'],
-        'first_name': input['first_name'],
-        'last_name': input['last_name'],
-        'api_key': auth_token
+        properties = tuple(PROPERTY_MAP.keys())
+    return properties, tuple(PROPERTY_MAP.get(p,'') for p in properties)
+
+def get_error_message(e):
+    # return a message for a failed lookup that can be shown in the row
+    # in place of the result
+    if isinstance(e, HunterApiError):
+        return 'Error: ' + str(e.status_code) + ' ' + e.reason
+    response = getattr(e, 'response', None)
+    if response is not None:
+        return 'Error: ' + str(response.status_code) + ' ' + (response.reason or '')
+    # the messages of requests' errors include the url and with it the api
+    # key, so only the kind of error is returned
+    if type(e).__module__.startswith('requests'):
+        return 'Error: ' + type(e).__name__
+    return 'Error: ' + str(e)
+
+# the score given to an email built from a domain's email pattern; it's kept
+# below the scores hunter gives to emails it has found
+PATTERN_SCORE = 10
+
+def find_person(domain, first_name, last_name, pattern, metrics):
+
+    # look up a person in the people indexed from domain-search responses by
+    # hunter-enrich-org; returns the person in the form of an email-finder
+    # response or None if the person isn't indexed
+    domain = normalize_name(domain)
+    first_name = normalize_name(first_name)
+    last_name = normalize_name(last_name)
+    now = time.time()
+    try:
+        with cache_lock:
+            connection = get_cache_connection()
+            row = connection.execute('select content from people where domain = ? and first_name = ? and last_name = ? and expires >= ?',
+                                     (domain, first_name, last_name, now)).fetchone()
+            if row is None and pattern is True:
+                info = connection.execute('select organization, pattern from domains where domain = ? and expires >= ?', (domain, now)).fetchone()
+    except sqlite3.Error:
+        return None
+
+    if row is not None:
+        metrics.add('local_hits')
+        return {'data': json_loads(row[0]), 'meta': {'source': 'domain-search'}}
+    if pattern is False or info is None:
+        return None
+
+    # build the email from the domain's pattern, e.g. '{first}.{l}'
+    email = get_pattern_email(info[1], first_name, last_name)
+    if email is None:
+        return None
+    metrics.add('pattern_hits')
+    person = {
+        'first_name': first_name,
+        'last_name': last_name,
+        'email': email + '@' + domain,
+        'score': PATTERN_SCORE,
+        'domain': domain,
+        'company': info[0]
     }
-    url_query_str = urllib.parse.urlencode(url_query_params)
-    url = 'https://api.hunter.io/v2/email-finder?' + url_query_str
+    return {'data': person, 'meta': {'source': 'pattern'}}
 
-    # get the response data as a JSON object
-    response = requests_retry_session().get(url)
-    response.raise_for_status()
-    content = response.json()
-    content = content.get('data', {})
+def get_pattern_email(pattern, first_name, last_name):
+    # returns the local part of an email built from a hunter email pattern;
+    # names are reduced to ascii letters and digits
+    import unicodedata
+    def to_ascii(value):
+        value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
+        return ''.join(c for c in value if c.isalnum())
+    first = to_ascii(first_name)
+    last = to_ascii(last_name)
+    if not pattern or first == '' or last == '':
+        return None
+    email = pattern.replace('{first}', first).replace('{last}', last).replace('{f}', first[0]).replace('{l}', last[0])
+    if '{' in email or '}' in email:
+        return None
+    return email
+
+def get_people(domains, first_names, last_names):
+    # pair up the domains, first names and last names into a list of people;
+    # a single value is used for every person and the other values need to
+    # have the same length
+    values = [domains, first_names, last_names]
+    count = max(len(v) for v in values)
+    if any(len(v) not in (1, count) for v in values):
+        return None
+    values = [v * count if len(v) == 1 else v for v in values]
+    return list(zip(*values))
 
-    # get the properties
-    result = [[content.get(property_map.get(p,''),'') or '' for p in properties]]
+def get_row_hash(row):
+    # return a short hash of a row's values; a row's hash only changes when
+    # its values do, so it can be compared with the hash returned for the
+    # row before to skip rows that haven't changed; the row is encoded the same
+    # way whichever json backend is in use so that its hash doesn't depend on it
+    import hashlib
+    content = json.dumps(row, ensure_ascii=False, separators=(',', ':'), default=to_string).encode('utf-8')
+    return hashlib.blake2b(content, digest_size=8).hexdigest()
 
-    # return the results
-    result = json.dumps(result, default=to_string)
+def write_rows(flex, rows, metrics, chunk_size=100):
+    # write the rows out as a JSON array a chunk at a time; returns the
+    # number of rows written
     flex.output.content_type = "application/json"
-    flex.output.write(result)
+    flex.output.write(b'[')
+    chunk = []
+    count = 0
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            metrics.mark('lookup')
+            flex.output.write((b',' if count > 0 else b'') + json_dumps(chunk)[1:-1])
+            metrics.mark('encode')
+            count = count + len(chunk)
+            chunk = []
+    metrics.mark('lookup')
+    if len(chunk) > 0:
+        flex.output.write((b',' if count > 0 else b'') + json_dumps(chunk)[1:-1])
+        count = count + len(chunk)
+    flex.output.write(b']')
+    metrics.mark('encode')
+    return count
+
+def get_request_options(config):
+    # get the options for the hunter api requests from the configuration settings
+    options = {}
+    options['cache'] = config.get('cache', 'true').lower() == 'true'
+    options['refresh'] = config.get('refresh', 'false').lower() == 'true'
+    options['timeout'] = float(config.get('timeout', 30))
+
+    # 'deadline' is the number of seconds an invocation's requests, including
+    # their retries and rate limit waits, have to complete in; requests that
+    # can't complete in time fail with a 504 in place of their result
+    deadline = config.get('deadline')
+    options['deadline'] = time.monotonic() + float(deadline) if deadline else None
+
+    # 'hedge' sends a second identical request when a request hasn't been
+    # answered within the endpoint's observed p95 latency; see send_request()
+    options['hedge'] = config.get('hedge', 'false').lower() == 'true'
+    options['rate_per_second'] = float(config.get('rate_per_second', 0))
+    options['rate_per_minute'] = float(config.get('rate_per_minute', 0))
+
+    # 'stale' serves expired responses at once for up to this many seconds
+    # past their expiry while they're refreshed in the background; 'true'
+    # serves them for as long as they're kept
+    stale = config.get('stale', 'false').lower()
+    stale = CACHE_STALE_MAX if stale == 'true' else 0 if stale == 'false' else float(stale)
+    options['stale'] = min(max(stale, 0), CACHE_STALE_MAX)
+    return options
+
+def map_concurrent(fn, items, concurrency):
+    # call fn for each of the items with at most 'concurrency' calls in flight
+    # and yield the results in the order of the items; if a call fails or the
+    # caller stops consuming the results, calls that haven't started are cancelled
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        yield from map(fn, items)
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    executor = ThreadPoolExecutor(max_workers=min(concurrency, len(items)))
+    try:
+        yield from executor.map(fn, items)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+# json encoding and decoding; orjson is used when it's available and is
+# otherwise stood in for by ujson for decoding and the standard library for
+# encoding; values are always encoded to utf-8 bytes; like requests, the
+# backend is only imported when it's first used
+@functools.lru_cache(maxsize=None)
+def get_json_backend():
+    # returns the dumps and loads functions of the backend
+    try:
+        import orjson
+        return (lambda value: orjson.dumps(value, default=to_string)), orjson.loads
+    except ImportError:
+        pass
+    dumps = lambda value: json.dumps(value, default=to_string, separators=(',', ':')).encode('utf-8')
+    try:
+        import ujson
+        return dumps, ujson.loads
+    except ImportError:
+        return dumps, json.loads
+
+def json_dumps(value):
+    return get_json_backend()[0](value)
+
+def json_loads(value):
+    return get_json_backend()[1](value)
+
+# instrumentation of the invocations; metrics are written for an invocation
+# when 'metrics=true' is in the config string or HUNTER_METRICS=true, and for
+# a random sample of the invocations with HUNTER_METRICS_SAMPLE_RATE (e.g. 0.01);
+# HUNTER_METRICS_FORMAT selects 'json' log lines or 'prometheus' text
+METRICS_ENABLED = os.environ.get('HUNTER_METRICS', 'false').lower() == 'true'
+METRICS_SAMPLE_RATE = float(os.environ.get('HUNTER_METRICS_SAMPLE_RATE', 0))
+METRICS_FORMAT = os.environ.get('HUNTER_METRICS_FORMAT', 'json').lower()
+
+class Metrics():
+
+    # times the phases of an invocation with mark(), which records the time
+    # since the previous mark, and totals the time and counters of the lookups
+    # made in it, which may run on several threads
+
+    def __init__(self, function):
+        self.function = function
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.phases = OrderedDict()
+        self.counters = {}
+
+    def enable(self, config):
+        enabled = config.get('metrics', '').lower()
+        if enabled == '':
+            self.enabled = METRICS_ENABLED or (METRICS_SAMPLE_RATE > 0 and random.random() < METRICS_SAMPLE_RATE)
+        else:
+            self.enabled = enabled == 'true'
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+    def add(self, name, value=1):
+        if self.enabled is False:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def emit(self):
+        if self.enabled is False:
+            return
+        total = time.perf_counter() - self.start
+        # the rate limiters are shared by the invocations, so their counters
+        # are totals for the process rather than for this invocation
+        rate_limiter_stats = get_rate_limiter_stats()
+        if METRICS_FORMAT == 'prometheus':
+            lines = []
+            for phase, seconds in self.phases.items():
+                lines.append('hunter_phase_seconds{function="%s",phase="%s"} %f' % (self.function, phase, seconds))
+            lines.append('hunter_phase_seconds{function="%s",phase="total"} %f' % (self.function, total))
+            for name, value in sorted(self.counters.items()):
+                lines.append('hunter_%s{function="%s"} %s' % (name, self.function, value))
+            for endpoint, stats in sorted(rate_limiter_stats.items()):
+                for name, value in sorted(stats.items()):
+                    lines.append('hunter_rate_limiter_%s{function="%s",endpoint="%s"} %s' % (name, self.function, endpoint, value))
+            sys.stderr.write('\n'.join(lines) + '\n')
+            return
+        metrics = {
+            'function': self.function,
+            'phases_ms': {phase: round(seconds*1000, 3) for phase, seconds in self.phases.items()},
+            'total_ms': round(total*1000, 3),
+            'counters': self.counters,
+            'rate_limiters': rate_limiter_stats
+        }
+        sys.stderr.write(json.dumps(metrics) + '\n')
+
+NO_METRICS = Metrics(None)
+
+def get_hunter_data(session, auth_tokens, endpoint, query, options, on_fetch=None):
+
+    # return a hunter api response, serving it from the response cache
+    # when possible; concurrent lookups of the same endpoint and query
+    # share a single request; on_fetch is called with responses fetched
+    # from the api when they're cached; requests are spread across the api
+    # keys given, but responses are cached and shared regardless of the key
+    metrics = options.get('metrics', NO_METRICS)
+    cache = options.get('cache', True)
+    refresh = options.get('refresh', False)
+    stale = options.get('stale', 0)
+    cache_key = get_cache_key(endpoint, query)
+    fetched = []
+    fetch = get_fetch(session, auth_tokens, endpoint, query, options, on_fetch, cache_key, fetched)
+    if cache is True and refresh is False:
+        start = time.perf_counter()
+        content, expired = cache_get(cache_key, stale)
+        metrics.add('cache_seconds', time.perf_counter() - start)
+        if content is not None and 'errors' in content and expired is False:
+            metrics.add('negative_cache_hits')
+            error = (content.get('errors') or [{}])[0]
+            raise HunterApiError(error.get('code', 500), error.get('details', ''))
+        if content is not None and 'errors' not in content:
+            if expired is True:
+                metrics.add('stale_hits')
+                # the revalidation runs on after this lookup has returned, so
+                # it isn't held to the lookup's deadline and its session retries
+                revalidate_fetch = get_fetch(get_session(), auth_tokens, endpoint, query, {**options, 'deadline': None}, on_fetch, cache_key, [])
+                revalidate(cache_key, lambda: single_flight(cache_key, functools.partial(revalidate_fetch, revalidating=True)))
+            else:
+                metrics.add('cache_hits')
+            return content
+        metrics.add('cache_misses')
+
+    content = single_flight(cache_key, fetch)
+    if len(fetched) == 0:
+        metrics.add('coalesced')
+    return content
+
+def get_fetch(session, auth_tokens, endpoint, query, options, on_fetch, cache_key, fetched):
+
+    # return a function that fetches a response from the api and caches it;
+    # this is kept apart from get_hunter_data so that a stale response can
+    # be revalidated after the lookup that served it has returned; failed
+    # revalidations aren't cached so that the stale response is kept
+    metrics = options.get('metrics', NO_METRICS)
+    cache = options.get('cache', True)
+    breaker = get_circuit_breaker(endpoint, query)
+    def fetch(revalidating=False):
+        fetched.append(True)
+        if breaker.allow() is False:
+            metrics.add('circuit_open')
+            raise HunterApiError(503, 'Service Unavailable (circuit open)')
+        try:
+            content = fetch_hunter_data(session, auth_tokens, endpoint, query, options)
+        except DeadlineExceeded:
+            # the lookup's own deadline says nothing about the domain
+            breaker.release()
+            raise
+        except (OSError, ValueError) as e:
+            # server errors and failed connections count against the domain's
+            # circuit breaker; other errors are the request's own
+            response = getattr(e, 'response', None)
+            status_code = response.status_code if response is not None else None
+            if status_code is None or status_code >= 500:
+                breaker.failure()
+            else:
+                breaker.success()
+            if cache is True and revalidating is False and status_code is not None and status_code not in KEY_ERROR_STATUSES:
+                error = {'errors': [{'code': status_code, 'details': response.reason or ''}]}
+                cache_put(endpoint, cache_key, error, NEGATIVE_CACHE_TTL if status_code < 500 else ERROR_CACHE_TTL)
+            raise
+        breaker.success()
+        if cache is True:
+            start = time.perf_counter()
+            cache_put(endpoint, cache_key, content, NEGATIVE_CACHE_TTL if is_empty(endpoint, content) else None)
+            if on_fetch is not None:
+                on_fetch(content)
+            metrics.add('cache_seconds', time.perf_counter() - start)
+        return content
+
+    return fetch
+
+# lookups that fail, or succeed without a result, are cached for a short time
+# so that recalcs don't repeat them; errors are cached in the form of a hunter
+# error response and raised again when they're served from the cache
+NEGATIVE_CACHE_TTL = 15*60
+
+# errors that depend on the api key used rather than on the lookup, which
+# aren't cached
+KEY_ERROR_STATUSES = (401, 403, 429)
+ERROR_CACHE_TTL = 30
+
+class HunterApiError(OSError):
+
+    # error of a lookup that wasn't made or was served from the cache; it's an
+    # OSError like the errors raised by requests
+
+    def __init__(self, status_code, reason):
+        super().__init__(str(status_code) + ' ' + reason)
+        self.status_code = status_code
+        self.reason = reason
+
+def is_empty(endpoint, content):
+    # true if a response has no result
+    data = content.get('data') or {}
+    if endpoint == 'domain-search':
+        return len(data.get('emails') or []) == 0
+    if endpoint == 'email-finder':
+        return not data.get('email')
+    return len(data) == 0
+
+# circuit breakers by endpoint and domain; once a domain's lookups fail
+# BREAKER_THRESHOLD times in a row, its lookups fail immediately until
+# BREAKER_COOLDOWN seconds have passed, after which a single probe lookup is
+# let through; the probe either closes the breaker or opens it again; the
+# breakers of the BREAKER_MAX_DOMAINS most recently looked up domains are kept,
+# so that a long-running process doesn't keep one for every domain it has seen
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 30
+BREAKER_MAX_DOMAINS = 10000
+breakers = OrderedDict()
+breakers_lock = threading.Lock()
+
+class CircuitBreaker():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = None
+        self.probing = False
+
+    def allow(self):
+        with self.lock:
+            if self.open_until is None:
+                return True
+            if self.probing is True or time.monotonic() < self.open_until:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.open_until = None
+            self.probing = False
+
+    def release(self):
+        # end a probe without an outcome, e.g. when the caller ran out of
+        # time, so that the next lookup can probe again
+        with self.lock:
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures = self.failures + 1
+            if self.probing is True or self.failures >= BREAKER_THRESHOLD:
+                self.open_until = time.monotonic() + BREAKER_COOLDOWN
+                self.probing = False
+
+def get_circuit_breaker(endpoint, query):
+    domain = query.get('domain') or str(query.get('email', '')).rsplit('@', 1)[-1]
+    key = (endpoint, normalize_name(domain))
+    with breakers_lock:
+        breaker = breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            breakers[key] = breaker
+            while len(breakers) > BREAKER_MAX_DOMAINS:
+                breakers.popitem(last=False)
+        else:
+            breakers.move_to_end(key)
+    return breaker
+
+def fetch_hunter_data(session, auth_tokens, endpoint, query, options):
+
+    # get the response data as a JSON object; requests are throttled by the
+    # rate limiter, which also retries requests that are rate limited; with a
+    # deadline, the session doesn't retry failed requests and server errors
+    # and they're retried here instead for as long as the deadline allows
+    import requests
+    metrics = options.get('metrics', NO_METRICS)
+    deadline = options.get('deadline')
+    rate_limited = 0
+    refused = 0
+    retries = 0
+    while True:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        auth_token, limiter, waited = acquire_key(session, auth_tokens, endpoint, options, remaining)
+        if waited is None:
+            raise DeadlineExceeded()
+        metrics.add('rate_limit_wait_seconds', waited)
+
+        # see here for more info:
+        # https://hunter.io/api/docs
+        url_query_params = {**query, 'api_key': auth_token}
+        url_query_str = urllib.parse.urlencode(url_query_params)
+        url = HUNTER_API_URL + endpoint + '?' + url_query_str
+
+        timeout = options.get('timeout')
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise DeadlineExceeded()
+        start = time.perf_counter()
+        try:
+            response = send_request(session, url, timeout, endpoint, options, limiter, metrics)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if deadline is None:
+                raise
+            error = e
+            response = None
+        metrics.add('request_seconds', time.perf_counter() - start)
+        metrics.add('requests')
+        if response is not None:
+            metrics.add('retries', len(getattr(getattr(response.raw, 'retries', None), 'history', ())))
+            # the bytes read off the wire, before any content-encoding is
+            # decoded, and the size of the decoded content
+            metrics.add('bytes_received', response.raw.tell())
+            metrics.add('bytes_decoded', len(response.content))
+            limiter.update(response)
+            if response.status_code in (401, 403) and refused < len(auth_tokens) - 1:
+                # a key that's refused is left out for a while and the
+                # request is made again with another key
+                refused = refused + 1
+                disable_key(auth_token)
+                metrics.add('keys_refused')
+                continue
+            if response.status_code == 200:
+                use_credit(auth_token, endpoint)
+            if response.status_code == 429 and rate_limited < RATE_LIMIT_RETRIES:
+                rate_limited = rate_limited + 1
+                metrics.add('rate_limited')
+                continue
+            if deadline is None or response.status_code not in RETRY_STATUSES:
+                break
+        # retry with a backoff if there's time left for the retry; as with
+        # the session's retries, the first retry is made at once
+        backoff = RETRY_BACKOFF * 2 ** retries if retries > 0 else 0
+        out_of_time = time.monotonic() + backoff >= deadline
+        if retries >= RETRY_LIMIT or out_of_time:
+            if response is not None:
+                break
+            if out_of_time is True and is_timeout(error):
+                # the request timed out because the deadline cut its timeout
+                # short, which isn't the domain's fault
+                raise DeadlineExceeded() from error
+            raise error
+        retries = retries + 1
+        metrics.add('retries')
+        time.sleep(backoff)
+    response.raise_for_status()
+    start = time.perf_counter()
+    content = prune_response(json_loads(response.content))
+    metrics.add('decode_seconds', time.perf_counter() - start)
+    return content
+
+def get_auth_tokens(variables, config):
+    # get the api keys to spread requests across; the 'hunter_api_key'
+    # variable can hold several keys separated by commas or spaces and the
+    # 'keys' config option can name more variables holding keys, so that the
+    # keys themselves aren't written in a sheet
+    names = ['hunter_api_key'] + [name.strip() for name in config.get('keys', '').split(',') if name.strip() != '']
+    auth_tokens = []
+    for name in names:
+        for auth_token in str(variables.get(name) or '').replace(',', ' ').split():
+            if auth_token not in auth_tokens:
+                auth_tokens.append(auth_token)
+    return tuple(auth_tokens)
+
+# state of the api keys requests are made with; with several keys, the
+# credits left on each key are read from its account every ACCOUNT_REFRESH
+# seconds and counted down as requests are made in between, and keys that
+# are refused are left out for KEY_DISABLE_SECONDS; see here for more info:
+# https://hunter.io/api/docs#account
+CREDIT_KINDS = {'domain-search': 'searches', 'email-finder': 'searches', 'email-verifier': 'verifications'}
+ACCOUNT_REFRESH = 10*60
+ACCOUNT_TIMEOUT = 10
+KEY_DISABLE_SECONDS = 10*60
+key_states = {}
+key_states_lock = threading.Lock()
+
+class KeyState():
+
+    def __init__(self):
+        self.credits = {} # credits left by kind; missing if unknown
+        self.used = 0
+        self.refreshed = None
+        self.disabled_until = 0
+
+def get_key_state(auth_token):
+    with key_states_lock:
+        state = key_states.get(auth_token)
+        if state is None:
+            state = KeyState()
+            key_states[auth_token] = state
+        return state
+
+def acquire_key(session, auth_tokens, endpoint, options, timeout=None):
+
+    # pick the api key for a request and take a token from its rate limiter;
+    # returns the key, its rate limiter and the time spent waiting, which is
+    # None if a token couldn't be taken within the timeout
+    if len(auth_tokens) == 1:
+        limiter = get_rate_limiter(auth_tokens[0], endpoint, options)
+        return auth_tokens[0], limiter, limiter.acquire(timeout)
+
+    # the keys are ranked by the most credits left, then by the fewest
+    # requests made, so that they're drained evenly; the first key with a
+    # request free is used and if none has one, the first key is waited on;
+    # keys without credits or that were refused are only used when there
+    # aren't any others
+    now = time.monotonic()
+    kind = CREDIT_KINDS.get(endpoint)
+    ranked = []
+    for auth_token in auth_tokens:
+        state = get_key_state(auth_token)
+        if state.refreshed is None or now - state.refreshed > ACCOUNT_REFRESH:
+            refresh_credits(session, auth_token, state)
+        credits = state.credits.get(kind, float('inf'))
+        ranked.append((credits <= 0 or state.disabled_until > now, -credits, state.used, auth_token))
+    ranked.sort()
+    ranked = [r for r in ranked if r[0] is False] or ranked
+    for unusable, credits, used, auth_token in ranked:
+        limiter = get_rate_limiter(auth_token, endpoint, options)
+        if limiter.acquire(0) is not None:
+            return auth_token, limiter, 0
+    limiter = get_rate_limiter(ranked[0][3], endpoint, options)
+    return ranked[0][3], limiter, limiter.acquire(timeout)
+
+def use_credit(auth_token, endpoint):
+    state = get_key_state(auth_token)
+    kind = CREDIT_KINDS.get(endpoint)
+    with key_states_lock:
+        state.used = state.used + 1
+        if kind in state.credits:
+            state.credits[kind] = state.credits[kind] - 1
+
+def disable_key(auth_token):
+    state = get_key_state(auth_token)
+    with key_states_lock:
+        state.disabled_until = time.monotonic() + KEY_DISABLE_SECONDS
+
+def refresh_credits(session, auth_token, state):
+
+    # read the credits left on a key from its account in the background;
+    # account requests don't use any credits
+    with key_states_lock:
+        now = time.monotonic()
+        if state.refreshed is not None and now - state.refreshed <= ACCOUNT_REFRESH:
+            return
+        state.refreshed = now
+
+    def run():
+        try:
+            url = HUNTER_API_URL + 'account?' + urllib.parse.urlencode({'api_key': auth_token})
+            response = session.get(url, timeout=ACCOUNT_TIMEOUT)
+            if response.status_code in (401, 403):
+                disable_key(auth_token)
+            response.raise_for_status()
+            usage = (json_loads(response.content).get('data', {}) or {}).get('requests', {}) or {}
+            credits = {}
+            for kind in ('searches', 'verifications'):
+                counts = usage.get(kind) or {}
+                if counts.get('available') is not None:
+                    credits[kind] = counts.get('available') - (counts.get('used') or 0)
+            with key_states_lock:
+                state.credits = credits
+        except Exception:
+            pass # the credits stay unknown until the next refresh
+
+    threading.Thread(target=run, daemon=True).start()
+
+# retries of failed requests and server errors under a deadline
+RETRY_STATUSES = (500, 502, 503, 504)
+RETRY_LIMIT = 3
+RETRY_BACKOFF = 0.3
+
+class DeadlineExceeded(HunterApiError):
+
+    # error of a lookup that couldn't be completed before the deadline
+
+    def __init__(self):
+        super().__init__(504, 'Deadline Exceeded')
+
+def is_timeout(e):
+    # true if a request failed by timing out; without retries in the session,
+    # urllib3's timeout errors reach requests wrapped in a MaxRetryError and
+    # are raised as a ConnectionError rather than a Timeout
+    import requests
+    from urllib3.exceptions import TimeoutError
+    if isinstance(e, requests.Timeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if len(e.args) > 0 else None
+    return isinstance(reason, TimeoutError)
+
+def send_request(session, url, timeout, endpoint, options, limiter, metrics):
+
+    # send a request; with the 'hedge' option, a second identical request is
+    # sent if the first hasn't been answered within the endpoint's observed p95
+    # latency and whichever is answered first is used; the second request
+    # takes a token from the rate limiter like any other and isn't sent if
+    # there isn't one free, and it may use an extra credit
+    delay = get_hedge_delay(endpoint) if options.get('hedge') is True else None
+    if delay is None or delay >= timeout:
+        return timed_get(session, url, timeout, endpoint)
+
+    # the delay is timed from when the first request is sent rather than from
+    # when it's queued, and no second request is sent while the pool has no
+    # free thread for it, so that lookups waiting on a busy pool aren't hedged
+    from concurrent import futures
+    executor = get_hedge_executor()
+    started = threading.Event()
+    def first_get():
+        started.set()
+        return hedge_get(session, url, timeout, endpoint)
+    first = executor.submit(first_get)
+    started.wait()
+    try:
+        return first.result(timeout=delay)
+    except futures.TimeoutError:
+        pass
+    with latencies_lock:
+        busy = hedge_running >= HEDGE_POOL_SIZE
+    if busy or limiter.acquire(0) is None:
+        return first.result()
+    metrics.add('hedged')
+    second = executor.submit(hedge_get, session, url, timeout - delay, endpoint)
+    pending = {first, second}
+    while True:
+        done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None or len(pending) == 0:
+                if future is second:
+                    metrics.add('hedge_wins')
+                return future.result()
+
+def hedge_get(session, url, timeout, endpoint):
+    # a request sent from the hedge pool; counts the requests that are running
+    global hedge_running
+    with latencies_lock:
+        hedge_running = hedge_running + 1
+    try:
+        return timed_get(session, url, timeout, endpoint)
+    finally:
+        with latencies_lock:
+            hedge_running = hedge_running - 1
+
+def timed_get(session, url, timeout, endpoint):
+    start = time.perf_counter()
+    response = session.get(url, timeout=timeout)
+    if response.status_code < 500 and response.status_code != 429:
+        add_latency(endpoint, time.perf_counter() - start)
+    return response
+
+# latencies of the latest answered requests by endpoint; requests are hedged
+# once there are enough of them to tell an endpoint's p95 latency
+HEDGE_SAMPLES = 200
+HEDGE_MIN_SAMPLES = 20
+HEDGE_PERCENTILE = 95
+latencies = {}
+latencies_lock = threading.Lock()
+hedge_executor = None
+hedge_running = 0
+
+def add_latency(endpoint, seconds):
+    with latencies_lock:
+        samples = latencies.get(endpoint)
+        if samples is None:
+            samples = deque(maxlen=HEDGE_SAMPLES)
+            latencies[endpoint] = samples
+        samples.append(seconds)
+
+def get_hedge_delay(endpoint):
+    with latencies_lock:
+        samples = sorted(latencies.get(endpoint) or ())
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return samples[min(len(samples), -(-len(samples) * HEDGE_PERCENTILE // 100)) - 1]
+
+def get_hedge_executor():
+    # a hedged lookup has both of its requests sent from this pool while the
+    # lookup's own thread waits for them
+    global hedge_executor
+    with latencies_lock:
+        if hedge_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE, thread_name_prefix='hunter-hedge')
+        return hedge_executor
+
+# fields of the api's responses that none of the functions return; they're
+# dropped from responses before they're cached, so responses served from the
+# cache are smaller and quicker to decode; the sources found for each email
+# make up most of a domain-search or email-finder response
+UNUSED_FIELDS = ('sources',)
+
+def prune_response(content):
+    data = content.get('data') if isinstance(content, dict) else None
+    if not isinstance(data, dict):
+        return content
+    for field in UNUSED_FIELDS:
+        data.pop(field, None)
+    for item in data.get('emails') or []:
+        if isinstance(item, dict):
+            for field in UNUSED_FIELDS:
+                item.pop(field, None)
+    return content
+
+# base url of the hunter api; can be pointed elsewhere, e.g. at a local stub
+# server for benchmarking
+HUNTER_API_URL = os.environ.get('HUNTER_API_URL', 'https://api.hunter.io/v2/')
+
+# lookups in flight by key; callers making the same lookup while it's in
+# flight wait for it and share its result rather than making their own request
+inflight = {}
+inflight_lock = threading.Lock()
+
+def single_flight(key, fn):
+    with inflight_lock:
+        future = inflight.get(key)
+        leader = future is None
+        if leader is True:
+            from concurrent.futures import Future
+            future = Future()
+            inflight[key] = future
+    if leader is False:
+        return future.result()
+    try:
+        result = fn()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with inflight_lock:
+            del inflight[key]
+
+# stale responses served by the 'stale' config option are revalidated in the
+# background by a small pool of threads, so the lookup that served a stale
+# response returns at once and the next lookup gets the fresh one; each key
+# is only queued once at a time and revalidations go through the same rate
+# limits and circuit breakers as other requests
+REVALIDATE_WORKERS = 4
+revalidator = None
+revalidating = set()
+revalidate_lock = threading.Lock()
+
+def revalidate(key, fn):
+    global revalidator
+    with revalidate_lock:
+        if key in revalidating:
+            return
+        if revalidator is None:
+            from concurrent.futures import ThreadPoolExecutor
+            revalidator = ThreadPoolExecutor(max_workers=REVALIDATE_WORKERS, thread_name_prefix='hunter-revalidate')
+        revalidating.add(key)
+    def run():
+        try:
+            fn()
+        except Exception:
+            pass # the stale response stays cached and is tried again on the next lookup
+        finally:
+            with revalidate_lock:
+                revalidating.discard(key)
+    revalidator.submit(run)
+
+# client-side rate limits for the hunter api by endpoint as (requests per second,
+# requests per minute); requests are throttled per api key and endpoint so that
+# the limits are held without running into 429 responses; see here for more info:
+# https://hunter.io/api/docs#rate-limiting
+RATE_LIMITS = {
+    'domain-search': (15, 500),
+    'email-finder': (15, 500),
+    'email-verifier': (10, 300)
+}
+RATE_LIMIT_DEFAULT = (10, 300)
+RATE_LIMIT_RETRIES = 3
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+class RateLimiter():
+
+    # token bucket rate limiter with a per-second and a per-minute bucket; the
+    # buckets are adjusted from the rate limit headers of the responses and all
+    # requests are held back while a 'Retry-After' period is in effect
+
+    def __init__(self, per_second, per_minute):
+        self.lock = threading.Lock()
+        self.buckets = [[per_second, per_second, 1], [per_minute, per_minute, 60]] # capacity, tokens, period
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.request_count = 0
+        self.wait_count = 0
+        self.wait_time = 0
+        self.throttle_count = 0
+
+    def set_rates(self, per_second, per_minute):
+        with self.lock:
+            self.buckets[0][0] = per_second
+            self.buckets[1][0] = per_minute
+
+    def acquire(self, timeout=None):
+        # wait until a request can be made and take a token from each bucket;
+        # returns the time spent waiting or None if a request can't be made
+        # within the timeout
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                for bucket in self.buckets:
+                    bucket[1] = min(bucket[0], bucket[1] + (now - self.updated) * bucket[0] / bucket[2])
+                self.updated = now
+                delay = max(self.blocked_until - now, 0)
+                for capacity, tokens, period in self.buckets:
+                    if tokens < 1:
+                        delay = max(delay, (1 - tokens) * period / capacity)
+                if delay == 0:
+                    for bucket in self.buckets:
+                        bucket[1] = bucket[1] - 1
+                    self.request_count = self.request_count + 1
+                    if waited > 0:
+                        self.wait_count = self.wait_count + 1
+                        self.wait_time = self.wait_time + waited
+                    return waited
+            if timeout is not None and waited + delay > timeout:
+                return None
+            time.sleep(delay)
+            waited = waited + delay
+
+    def update(self, response):
+        # adapt to the rate limit headers of a response
+        headers = response.headers
+        now = time.monotonic()
+        with self.lock:
+            remaining = to_number(headers.get('X-RateLimit-Remaining'))
+            if remaining is not None:
+                self.buckets[1][1] = min(self.buckets[1][1], remaining)
+            if response.status_code == 429:
+                self.throttle_count = self.throttle_count + 1
+                retry_after = to_number(headers.get('Retry-After'))
+                if retry_after is None:
+                    retry_after = to_number(headers.get('X-RateLimit-Reset'))
+                if retry_after is None:
+                    retry_after = 1
+                self.blocked_until = max(self.blocked_until, now + min(retry_after, 60))
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'requests': self.request_count,
+                'waits': self.wait_count,
+                'wait_time': self.wait_time,
+                'throttled': self.throttle_count
+            }
+
+def get_rate_limiter(auth_token, endpoint, options):
+    per_second, per_minute = RATE_LIMITS.get(endpoint, RATE_LIMIT_DEFAULT)
+    per_second = options.get('rate_per_second') or per_second
+    per_minute = options.get('rate_per_minute') or per_minute
+    key = (auth_token, endpoint)
+    with rate_limiters_lock:
+        limiter = rate_limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(per_second, per_minute)
+            rate_limiters[key] = limiter
+    limiter.set_rates(per_second, per_minute)
+    return limiter
+
+def get_rate_limiter_stats():
+    # get the request, wait and throttle counters of the rate limiters
+    # totaled by endpoint
+    with rate_limiters_lock:
+        limiters = list(rate_limiters.items())
+    stats = {}
+    for (auth_token, endpoint), limiter in limiters:
+        totals = stats.setdefault(endpoint, {})
+        for k, v in limiter.get_stats().items():
+            totals[k] = totals.get(k, 0) + v
+    return stats
+
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# response cache shared by all the hunter functions; responses are stored
+# in a sqlite database on local disk so that lookups made by any of the
+# functions can be reused across invocations until they expire; the cache
+# holds people's names, emails and phone numbers, so it's only readable by the
+# user that created it, and by default it's kept in a directory of that user's
+# that no other user can have created first
+CACHE_PATH = os.environ.get('HUNTER_CACHE_PATH')
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'flexio-hunter-%d' % os.getuid())
+CACHE_MAX_BYTES = int(os.environ.get('HUNTER_CACHE_MAX_BYTES', 64*1024*1024))
+CACHE_TTL = {
+    'domain-search': 7*24*60*60,
+    'email-finder': 7*24*60*60,
+    'email-verifier': 24*60*60
+}
+CACHE_DEFAULT_TTL = 24*60*60
+
+# expired responses are kept for up to this long past their expiry so that
+# they can be served while they're revalidated
+CACHE_STALE_MAX = int(os.environ.get('HUNTER_CACHE_STALE_MAX', 30*24*60*60))
+
+# the people and domains indexed from domain-search responses are capped at
+# this many rows each; the rows that expire soonest, which are the oldest,
+# are removed first
+INDEX_MAX_ROWS = int(os.environ.get('HUNTER_INDEX_MAX_ROWS', 100000))
+
+# the cache is brought back under its size limit every CACHE_EVICT_INTERVAL
+# puts or CACHE_EVICT_SECONDS seconds, or sooner once the puts since then may
+# have taken it over; eviction takes it down to CACHE_EVICT_TARGET of the limit
+# so that it isn't needed again right away, and removes rows a batch at a time
+# through the expires and accessed indexes so that its cost depends on the
+# rows removed rather than on the size of the cache
+CACHE_EVICT_INTERVAL = 1000
+CACHE_EVICT_SECONDS = 60
+CACHE_EVICT_TARGET = 0.9
+CACHE_EVICT_BATCH = 500
+CACHE_EVICT_MAX_BATCHES = 10
+cache_connection = None
+cache_lock = threading.Lock()
+cache_bytes = None # size of the cache as of the last eviction plus the puts since
+cache_puts = 0
+cache_evicted = 0
+index_rows = None # rows indexed as of the last eviction plus those indexed since
+
+def normalize_name(value):
+    # names are matched case-insensitively and ignoring extra whitespace
+    return ' '.join(str(value or '').lower().split())
+
+def get_cache_key(endpoint, query):
+    # the cache key is the endpoint and the normalized query; the api key
+    # is left out so results can be shared between api keys
+    items = sorted((k, str(v).lower().strip()) for k, v in query.items() if k != 'api_key')
+    return endpoint + '?' + urllib.parse.urlencode(items)
+
+def get_cache_path():
+    # the cache is created here rather than by sqlite so that it's private to
+    # this user, and sqlite creates its journal files with the same permissions;
+    # errors are raised as sqlite errors so that the functions carry on without
+    # the cache
+    path = CACHE_PATH
+    try:
+        if path is None:
+            try:
+                os.mkdir(CACHE_DIR, 0o700)
+            except FileExistsError:
+                pass
+            info = os.lstat(CACHE_DIR)
+            if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077 != 0:
+                raise sqlite3.OperationalError('cache directory not private to this user: ' + CACHE_DIR)
+            path = os.path.join(CACHE_DIR, 'cache.sqlite')
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+    except OSError as e:
+        raise sqlite3.OperationalError(str(e))
+    return path
+
+def get_cache_connection():
+    global cache_connection
+    if cache_connection is None:
+        connection = sqlite3.connect(get_cache_path(), timeout=5, isolation_level=None, check_same_thread=False)
+        connection.execute('pragma journal_mode=wal')
+        connection.execute('create table if not exists cache (key text primary key, content text not null, size integer not null, expires real not null, accessed real not null)')
+        connection.execute('create index if not exists cache_accessed on cache (accessed)')
+        connection.execute('create index if not exists cache_expires on cache (expires)')
+        connection.execute('create table if not exists domains (domain text primary key, organization text, pattern text, expires real not null)')
+        connection.execute('create table if not exists people (domain text not null, first_name text not null, last_name text not null, content text not null, expires real not null, primary key (domain, first_name, last_name))')
+        connection.execute('create index if not exists domains_expires on domains (expires)')
+        connection.execute('create index if not exists people_expires on people (expires)')
+        cache_connection = connection
+    return cache_connection
+
+def cache_get(key, grace=0):
+    # return the cached content for a key and whether it has expired; expired
+    # content is only returned within 'grace' seconds of its expiry
+    now = time.time()
+    try:
+        with cache_lock:
+            connection = get_cache_connection()
+            row = connection.execute('select content, expires from cache where key = ?', (key,)).fetchone()
+            if row is None or row[1] + grace < now:
+                return None, False
+            connection.execute('update cache set accessed = ? where key = ?', (now, key))
+        return json_loads(row[0]), row[1] < now
+    except sqlite3.Error:
+        return None, False
+
+def cache_put(endpoint, key, content, ttl=None):
+    global cache_bytes, cache_puts
+    now = time.time()
+    content = json_dumps(content)
+    if ttl is None:
+        ttl = CACHE_TTL.get(endpoint, CACHE_DEFAULT_TTL)
+    try:
+        with cache_lock:
+            connection = get_cache_connection()
+            connection.execute('insert or replace into cache (key, content, size, expires, accessed) values (?, ?, ?, ?, ?)',
+                               (key, content, len(content), now + ttl, now))
+            cache_puts = cache_puts + 1
+            if cache_bytes is not None:
+                cache_bytes = cache_bytes + len(content)
+            if (cache_bytes is None or cache_bytes > CACHE_MAX_BYTES or cache_puts >= CACHE_EVICT_INTERVAL or
+                    now - cache_evicted >= CACHE_EVICT_SECONDS):
+                cache_evict(connection)
+    except sqlite3.Error:
+        pass
+
+def cache_evict(connection):
+    # remove expired entries, then the least recently used entries until
+    # the cache is under its target size and the oldest indexed people and
+    # domains over their cap; called with the cache lock held
+    global cache_puts, cache_evicted
+    now = time.time()
+    connection.execute('begin')
+    try:
+        evict_rows(connection, now)
+        connection.execute('commit')
+    except sqlite3.Error:
+        connection.execute('rollback')
+        raise
+    cache_evicted = now
+    cache_puts = 0
+
+def evict_rows(connection, now):
+    global cache_bytes, index_rows
+    for table, expired in (('cache', now - CACHE_STALE_MAX), ('domains', now), ('people', now)):
+        for i in range(CACHE_EVICT_MAX_BATCHES):
+            cursor = connection.execute('delete from ' + table + ' where rowid in (select rowid from ' + table + ' where expires < ? limit ?)',
+                                        (expired, CACHE_EVICT_BATCH))
+            if cursor.rowcount < CACHE_EVICT_BATCH:
+                break
+    total = connection.execute('select coalesce(sum(size), 0) from cache').fetchone()[0]
+    if total > CACHE_MAX_BYTES:
+        target = CACHE_MAX_BYTES * CACHE_EVICT_TARGET
+        while total > target:
+            rows = connection.execute('select rowid, size from cache order by accessed limit ?', (CACHE_EVICT_BATCH,)).fetchall()
+            if len(rows) == 0:
+                break
+            evicted = []
+            for rowid, size in rows:
+                if total <= target:
+                    break
+                evicted.append((rowid,))
+                total = total - size
+            connection.executemany('delete from cache where rowid = ?', evicted)
+    cache_bytes = total
+    rows = 0
+    for table in ('people', 'domains'):
+        count = connection.execute('select count(*) from ' + table).fetchone()[0]
+        if count > INDEX_MAX_ROWS:
+            target = int(INDEX_MAX_ROWS * CACHE_EVICT_TARGET)
+            while count > target:
+                cursor = connection.execute('delete from ' + table + ' where rowid in (select rowid from ' + table + ' order by expires limit ?)',
+                                            (min(count - target, CACHE_EVICT_BATCH),))
+                if cursor.rowcount <= 0:
+                    break
+                count = count - cursor.rowcount
+        rows = max(rows, count)
+    index_rows = rows
+
+# session shared by all invocations in this process; connections to the
+# hunter api are kept alive in its pool so that warm invocations don't pay
+# for a new connection and tls handshake
+SESSION_POOL_SIZE = int(os.environ.get('HUNTER_POOL_SIZE', 16))
+HEDGE_POOL_SIZE = 2*SESSION_POOL_SIZE # threads that send the requests of hedged lookups
+session_instances = {}
+session_lock = threading.Lock()
+
+def get_session(retry=True):
+    # with retry=False, the session doesn't retry failed requests and server
+    # errors, so that the caller can retry them within its own time budget
+    session = session_instances.get(retry)
+    if session is None:
+        with session_lock:
+            session = session_instances.get(retry)
+            if session is None:
+                # rate limited (429) responses are retried by the rate limiter
+                # rather than by the session; once the retries run out, the
+                # last server error is returned rather than raised so that it
+                # reaches the caller with its status and can be negative cached
+                session = requests_retry_session(
+                    retries=3 if retry is True else 0,
+                    status_forcelist=(500, 502, 503, 504) if retry is True else (),
+                    pool_maxsize=SESSION_POOL_SIZE,
+                    respect_retry_after_header=False,
+                    raise_on_status=False
+                )
+                # ask for compressed responses in every encoding urllib3 can
+                # decode here; brotli (br) is included when the brotli package
+                # is installed
+                from urllib3.util import make_headers
+                session.headers['Accept-Encoding'] = make_headers(accept_encoding=True)['accept-encoding']
+                session_instances[retry] = session
+    return session
 
 def requests_retry_session(
     retries=3,
     backoff_factor=0.3,
     status_forcelist=(429, 500, 502, 503, 504),
     session=None,
+    pool_maxsize=10,
+    respect_retry_after_header=True,
+    raise_on_status=True,
 ):
+    # requests is only imported once a request needs to be made so that
+    # invocations served from the cache don't pay for importing it
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
+
     session = session or requests.Session()
     retry = Retry(
         total=retries,
@@ -146,8 +1405,10 @@ def requests_retry_session(
         connect=retries,
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
+        respect_retry_after_header=respect_retry_after_header,
+        raise_on_status=raise_on_status,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
@@ -165,9 +1426,20 @@ def validator_list(field, value, error):
 def to_string(value):
     if isinstance(value, (date, datetime)):
         return value.isoformat()
-    if isinstance(value, (Decimal)):
-        return str(value)
-    return value
+    return str(value)
+
+def to_value_list(value):
+    # if we have a single value, create a list from it; if we have a list
+    # of values or a list of lists (e.g. a range), flatten it into a single
+    # list of values
+    if isinstance(value, str):
+        return [value.strip()]
+    if isinstance(value, list):
+        items = []
+        for item in value:
+            items.extend(item if isinstance(item, list) else [item])
+        return [item.strip() if isinstance(item, str) else '' for item in items]
+    return None
 
 def to_list(value):
     # if we have a list of strings, create a list from them; if we have
@@ -0,0 +1,242 @@
+# Local server for the Hunter functions
+#
+# Loads hunter-enrich-org.py, hunter-enrich-people.py and hunter-verify-email.py
+# once and serves them from one long-running process, so that the functions'
+# connection pools, rate limiters, circuit breakers and in-process caches stay
+# warm between calls instead of being rebuilt for each invocation. Each
+# function takes the same positional JSON input as its flexio_handler, POSTed
+# to the function's path, and returns the function's output:
+#
+#   curl -d '["steli@close.io", "score, status"]' http://127.0.0.1:8902/hunter-verify-email
+#
+# The short names org, people and verify can be used as the path as well, and
+# GET /health lists the functions and the counters of their rate limiters.
+# Requests are taken concurrently and run on a pool of worker threads, and the
+# functions' connection pools are sized for the number of workers unless
+# HUNTER_POOL_SIZE is set. The api key is read from HUNTER_API_KEY (which may
+# hold several keys) and can be given per request in an 'X-Hunter-Api-Key'
+# header; other flex variables can be set with --var, e.g. for the 'keys'
+# config option.
+#
+# Usage:
+#   python tools/serve.py [--host 127.0.0.1] [--port 8902] [--socket PATH]
+#                         [--workers 32] [--var name=value ...]
+
+import argparse
+import errno
+import importlib.util
+import json
+import os
+import socketserver
+import stat
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FUNCTIONS = {
+    'hunter-enrich-org': 'hunter-enrich-org.py',
+    'hunter-enrich-people': 'hunter-enrich-people.py',
+    'hunter-verify-email': 'hunter-verify-email.py'
+}
+ALIASES = {
+    'org': 'hunter-enrich-org',
+    'people': 'hunter-enrich-people',
+    'verify': 'hunter-verify-email'
+}
+
+# largest request body accepted
+MAX_INPUT_BYTES = 16*1024*1024
+
+# lookups each invocation makes at once unless its 'concurrency' config
+# option says otherwise; the functions' connection pools are sized for this
+# many lookups from each worker so that connections aren't discarded under load
+FUNCTION_CONCURRENCY = 8
+
+class FlexInput():
+
+    def __init__(self, content):
+        self.content = content
+
+    def read(self):
+        return self.content
+
+class FlexOutput():
+
+    def __init__(self):
+        self.content_type = None
+        self.chunks = []
+
+    def write(self, content):
+        self.chunks.append(content if isinstance(content, bytes) else str(content).encode('utf-8'))
+
+class Flex():
+
+    # the parts of the flex object the functions use
+
+    def __init__(self, variables, input):
+        self.vars = variables
+        self.input = FlexInput(input)
+        self.output = FlexOutput()
+
+class Server():
+
+    # the loaded functions and the pool of threads their invocations run on
+
+    def __init__(self, variables, workers):
+        self.variables = variables
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hunter-worker')
+        # the functions read the pool size when they're loaded; a size that's
+        # been set explicitly is kept
+        os.environ.setdefault('HUNTER_POOL_SIZE', str(max(16, workers * FUNCTION_CONCURRENCY)))
+        self.modules = {name: load_function(filename) for name, filename in FUNCTIONS.items()}
+
+    def invoke(self, name, input, variables):
+        # run a function's handler on a worker thread; returns the output's
+        # content type and content
+        def run():
+            flex = Flex({**self.variables, **variables}, input)
+            self.modules[name].flexio_handler(flex)
+            return flex.output.content_type or 'application/json', b''.join(flex.output.chunks)
+        return self.executor.submit(run).result()
+
+class ServerHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    server_instance = None # set on the subclass created for each server
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/health':
+            return self.send_json(404, {'error': 'Not Found'})
+        rate_limiters = {name: module.get_rate_limiter_stats() for name, module in self.server_instance.modules.items()}
+        self.send_json(200, {'functions': list(FUNCTIONS), 'rate_limiters': rate_limiters})
+
+    def do_POST(self):
+        # the body is read before anything else so that the connection can be
+        # kept alive for the next request whatever the response
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_INPUT_BYTES:
+            self.close_connection = True
+            return self.send_json(413, {'error': 'Payload Too Large'})
+        input = self.rfile.read(length).decode('utf-8')
+
+        name = self.path.strip('/').split('?', 1)[0]
+        name = ALIASES.get(name, name)
+        if name not in FUNCTIONS:
+            return self.send_json(404, {'error': 'Not Found'})
+
+        variables = {}
+        if self.headers.get('X-Hunter-Api-Key'):
+            variables['hunter_api_key'] = self.headers.get('X-Hunter-Api-Key')
+        try:
+            content_type, content = self.server_instance.invoke(name, input, variables)
+        except ValueError:
+            # the functions raise a ValueError for input they can't take
+            return self.send_json(400, {'error': 'Bad Request'})
+        except Exception as e:
+            return self.send_json(500, {'error': type(e).__name__})
+        self.send_content(200, content_type, content)
+
+    def send_json(self, status, content):
+        self.send_content(status, 'application/json', json.dumps(content).encode('utf-8'))
+
+    def send_content(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class HttpServer(ThreadingHTTPServer):
+
+    request_queue_size = 256
+    daemon_threads = True
+
+class UnixHttpServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    request_queue_size = 256
+    daemon_threads = True
+
+class UnixServerHandler(ServerHandler):
+
+    # unix sockets have no nagle algorithm to disable and their clients have
+    # no address
+    disable_nagle_algorithm = False
+
+    def address_string(self):
+        return 'unix'
+
+def load_function(filename):
+    spec = importlib.util.spec_from_file_location(filename[:-3].replace('-', '_'), os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def get_variables(values):
+    # get the flex variables from HUNTER_API_KEY and the --var options
+    variables = {}
+    if os.environ.get('HUNTER_API_KEY'):
+        variables['hunter_api_key'] = os.environ.get('HUNTER_API_KEY')
+    for value in values or []:
+        name, sep, value = value.partition('=')
+        if sep == '':
+            raise ValueError('expected name=value: ' + name)
+        variables[name.strip()] = value
+    return variables
+
+def start_server(server_instance, host='127.0.0.1', port=0, socket_path=None):
+    # start serving in a background thread and return the server
+    if socket_path is not None:
+        # a socket left by an earlier server is replaced, but any other file
+        # at the path is left alone
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise FileExistsError(errno.EEXIST, 'Not a socket', socket_path)
+            os.remove(socket_path)
+        handler = type('ConfiguredServerHandler', (UnixServerHandler,), {'server_instance': server_instance})
+        server = UnixHttpServer(socket_path, handler)
+    else:
+        handler = type('ConfiguredServerHandler', (ServerHandler,), {'server_instance': server_instance})
+        server = HttpServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the Hunter functions from one warm local process')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8902)
+    parser.add_argument('--socket', help='serve on this unix socket instead of a tcp port')
+    parser.add_argument('--workers', type=int, default=32, help='number of invocations run at once')
+    parser.add_argument('--var', action='append', help='flex variable given to every invocation as name=value')
+    args = parser.parse_args()
+
+    server_instance = Server(get_variables(args.var), max(1, args.workers))
+    try:
+        server = start_server(server_instance, args.host, args.port, args.socket)
+    except OSError as e:
+        print('Unable to serve the Hunter functions: %s' % e, file=sys.stderr)
+        return 1
+    if args.socket is not None:
+        print('Serving the Hunter functions on unix socket %s' % args.socket, file=sys.stderr)
+    else:
+        print('Serving the Hunter functions at http://%s:%d/' % (args.host, server.server_port), file=sys.stderr)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())